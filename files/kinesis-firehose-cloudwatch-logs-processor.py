@@ -48,11 +48,24 @@ The code below will:
 import os
 import base64
 import json
-import gzip
-from io import BytesIO, BufferedReader
 import boto3
 import logging
-import datetime
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# isal_zlib is a drop-in replacement for zlib backed by ISA-L; like orjson it is only available through a layer
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
@@ -62,226 +75,333 @@ logging.getLogger('s3transfer').setLevel(logging.CRITICAL)
 logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 
 maxSize = int(os.getenv("MAXSIZE", "9900000"))
+# zlib/isal inflate runs outside the GIL, JSON parsing and serialization do not, so threads only help gzip heavy
+# records, and only when the function has more than one vCPU (memory_size above roughly 1769 MB)
+processingThreads = int(os.getenv("PROCESSING_THREADS", "1"))
+# seconds, used to back off between reingestion retries
+baseBackoff = 0.05
+maxBackoff = 5.0
+# seconds left for the last put call and returning to Firehose, see hasTimeToRetry
+retryTimeMargin = 10.0
+
+# boto3 clients keyed by (service, region), see getClient
+clients = {}
+
+# orjson is not part of the Lambda runtime; it is picked up when provided through a layer (see var.lambda_layers),
+# otherwise the stdlib json module is used. jsonDumps always returns UTF-8 encoded bytes. orjson.JSONDecodeError is a
+# subclass of json.JSONDecodeError, so JSONDecodeError covers both.
+JSONDecodeError = json.JSONDecodeError
+if orjson is not None:
+
+    def jsonDumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # lone surrogates parsed by the json fallback below are not valid UTF-8, json escapes them instead
+            return json.dumps(obj).encode("utf-8")
+
+    def jsonLoads(doc):
+        try:
+            return orjson.loads(doc)
+        except JSONDecodeError:
+            # orjson rejects NaN/Infinity and lone surrogate escapes that json accepts, retry before giving up on doc
+            return json.loads(doc)
+
+else:
+    jsonLoads = json.loads
+
+    def jsonDumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 
-def isgzip(stream):
-    buf = stream.peek(3)
-    return buf[0] == 0x1F and buf[1] == 0x8B and buf[2] == 0x08
+def gunzip(data):
+    # zlib.decompress stops after the first gzip member, keep going until all members are consumed
+    members = []
+    while data:
+        decompressor = zlib.decompressobj(wbits=31)
+        members.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        # like GzipFile, ignore NUL padding between and after members
+        data = decompressor.unused_data.lstrip(b"\x00")
+    return b"".join(members)
 
 
-def transformLogEvent(log_event, owner, group, stream):
+@lru_cache(maxsize=128)
+def recordFields(owner, group, stream):
+    # owner, log_group and log_stream are the same for every event of a record, serialize them once as a JSON member
+    # list (without braces) that transformLogEvent appends to each serialized event
+    return b"," + jsonDumps({"owner": owner, "log_group": group, "log_stream": stream})[1:-1]
+
+
+def transformLogEvent(log_event, owner, group, stream, now):
     """Transform each log event.
 
     The default implementation below just extracts the message and appends a newline to it.
 
     Args:
     log_event (dict): The original log event. Structure is {"id": str, "timestamp": long, "message": str}
+    now (str): Timestamp to use for events that do not carry one, see utcTimestamp.
 
     Returns:
-    str: The transformed log event.
+    bytes: The transformed log event.
     """
+    if (
+        "timestamp" in log_event
+        and "owner" not in log_event
+        and "log_group" not in log_event
+        and "log_stream" not in log_event
+    ):
+        # fast path: splice the serialized record fields into the serialized event rather than adding them to it
+        return b'{"event":' + jsonDumps(log_event)[:-1] + recordFields(owner, group, stream) + b"}}\n"
+
     log_event["owner"] = owner
     log_event["log_group"] = group
     log_event["log_stream"] = stream
-    log_event = addTimestamp(log_event)
-    log_event = addEventWrapper(log_event)
-    return json.dumps(log_event) + "\n"
+    log_event = addTimestamp(log_event, now)
+    return jsonDumps({"event": log_event}) + b"\n"
+
+
+def utcTimestamp():
+    # same output as datetime.utcnow().strftime("%Y-%m-%dT%X.%fZ") without the datetime and strftime overhead
+    seconds, micros = divmod(time.time_ns() // 1000, 1000000)
+    tm = time.gmtime(seconds)
+    return "%04d-%02d-%02dT%02d:%02d:%02d.%06dZ" % (
+        tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec, micros
+    )
 
 
-def addTimestamp(event):
+def addTimestamp(event, now):
     if "timestamp" not in event:
-        ts = {
-            "timestamp": datetime.datetime.utcnow()
-            .replace(tzinfo=datetime.timezone.utc)
-            .strftime("%Y-%m-%dT%X.%fZ")
-        }
+        ts = {"timestamp": now}
         ts.update(event)
         event = ts
     return event
 
 
-def addEventWrapper(event):
-    ev = {}
-    ev["event"] = event
-    return ev
+def processRecords(records):
+    """Transform the records of a Firehose event.
 
+    Yields a (result, rawdata) tuple per input record, in order, see processRecord. Records are spread over a thread
+    pool when the PROCESSING_THREADS environment variable is set above 1, which only pays off with more than one vCPU.
+    """
+    # events without a timestamp of their own are stamped with the time the batch started processing
+    now = utcTimestamp()
+    if processingThreads > 1:
+        with ThreadPoolExecutor(max_workers=processingThreads) as executor:
+            yield from executor.map(processRecord, records, repeat(now))
+    else:
+        for r in records:
+            yield processRecord(r, now)
 
-def processRecords(records):
-    for r in records:
-        rawdata = base64.b64decode(r["data"])
-        bytesiodata = BufferedReader(BytesIO(rawdata))
-        if isgzip(bytesiodata):
-            doc = gzip.GzipFile(fileobj=bytesiodata, mode="r").read().decode("utf-8")
-        else:
-            doc = bytesiodata.read().decode("utf-8")
-
-        recId = r["recordId"]
-        logger.info("processing doc, recordId={} size={}".format(recId, len(doc)))
-        logger.debug("doc: " + doc)
-        """
-        CONTROL_MESSAGE are sent by CWL to check if the subscription is reachable.
-        They do not contain actual data.
-        """
-        try:
-            data = json.loads(doc)
-        except json.decoder.JSONDecodeError:
-            plaintext = {}
-            plaintext = addTimestamp(plaintext)
-            plaintext["message"] = doc
-            message = json.dumps(addEventWrapper(plaintext))
-            logger.info("plaintext size={}".format(len(message)))
-            logger.debug("plaintext: " + message)
-            yield {
-                "data": base64.b64encode((message + "\n").encode("utf-8")),
-                "result": "Ok",
-                "recordId": recId,
-            }
-            continue
 
-        if "messageType" in data:
-            if data["messageType"] == "CONTROL_MESSAGE":
-                yield {"result": "Dropped", "recordId": recId}
-            elif data["messageType"] == "DATA_MESSAGE":
-                message = "".join(
-                    [
-                        transformLogEvent(
-                            e, data["owner"], data["logGroup"], data["logStream"]
-                        )
-                        for e in data["logEvents"]
-                    ]
-                )
-                message = base64.b64encode(message.encode("utf-8"))
-                yield {"data": message, "result": "Ok", "recordId": recId}
-            else:
-                yield {"result": "ProcessingFailed", "recordId": recId}
-        elif "container_id" in data and "log" in data:
-            try:
-                logdata = json.loads(data["log"])
-                data.update(logdata)
-                del data["log"]
-            except json.decoder.JSONDecodeError:
-                pass
-            message = json.dumps(addEventWrapper(data)) + "\n"
-            message = base64.b64encode(message.encode("utf-8"))
-            yield {"data": message, "result": "Ok", "recordId": recId}
+def processRecord(r, now):
+    """Transform a single Firehose record.
+
+    Returns a (result, rawdata) tuple where result is the record to return to Firehose and rawdata is the base64
+    decoded data of the input record, kept around for reingestion. The data of the result is not base64 encoded yet,
+    handler only encodes the records it does not reingest.
+    """
+    rawdata = base64.b64decode(r["data"])
+    if rawdata[:3] == b"\x1f\x8b\x08":
+        doc = gunzip(rawdata)
+    else:
+        doc = rawdata
+
+    recId = r["recordId"]
+    logger.info("processing doc, recordId=%s size=%d", recId, len(doc))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("doc: %s", doc.decode("utf-8"))
+    """
+    CONTROL_MESSAGE are sent by CWL to check if the subscription is reachable.
+    They do not contain actual data.
+    """
+    # only try to parse documents that can be a JSON object, array or string, anything else is plaintext and would
+    # only be rejected by the parser after scanning it
+    data = None
+    if doc.lstrip()[:1] in (b"{", b"[", b'"'):
+        try:
+            data = jsonLoads(doc)
+        except JSONDecodeError:
+            pass
+
+    if data is None:
+        plaintext = {"timestamp": now}
+        plaintext["message"] = doc.decode("utf-8")
+        message = jsonDumps({"event": plaintext})
+        logger.info("plaintext size=%d", len(message))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("plaintext: %s", message.decode("utf-8"))
+        return {
+            "data": message + b"\n",
+            "result": "Ok",
+            "recordId": recId,
+        }, rawdata
+
+    # valid JSON is not necessarily an object, only objects can carry a messageType or container fields
+    messageType = data.get("messageType") if isinstance(data, dict) else None
+    if messageType == "DATA_MESSAGE":
+        owner = data["owner"]
+        group = data["logGroup"]
+        stream = data["logStream"]
+        parts = [
+            transformLogEvent(e, owner, group, stream, now) for e in data["logEvents"]
+        ]
+        message = b"".join(parts)
+        return {"data": message, "result": "Ok", "recordId": recId}, rawdata
+    elif messageType == "CONTROL_MESSAGE":
+        return {"result": "Dropped", "recordId": recId}, rawdata
+    elif messageType is not None:
+        return {"result": "ProcessingFailed", "recordId": recId}, rawdata
+    elif isinstance(data, dict) and "container_id" in data and "log" in data:
+        # drop the nested document before merging it in so a "log" key inside it is kept
+        try:
+            logdata = jsonLoads(data["log"])
+        except JSONDecodeError:
+            pass
         else:
-            message = json.dumps(addEventWrapper(data)) + "\n"
-            message = base64.b64encode(message.encode("utf-8"))
-            yield {"data": message, "result": "Ok", "recordId": recId}
+            del data["log"]
+            data.update(logdata)
+        message = jsonDumps({"event": data}) + b"\n"
+        return {"data": message, "result": "Ok", "recordId": recId}, rawdata
+    else:
+        message = jsonDumps({"event": data}) + b"\n"
+        return {"data": message, "result": "Ok", "recordId": recId}, rawdata
 
 
-def putRecordsToFirehoseStream(streamName, records, client, attemptsMade, maxAttempts):
-    logger.debug(
-        "putRecordsToFirehoseStream: streamName={} cntOfRecords={} attemptsMade={} maxAttempts={}".format(
-            streamName, len(records), attemptsMade, maxAttempts
-        )
-    )
-    failedRecords = []
-    codes = []
-    errMsg = ""
-    # if put_record_batch throws for whatever reason, response['xx'] will error out, adding a check for a valid
-    # response will prevent this
-    response = None
-    try:
-        response = client.put_record_batch(
-            DeliveryStreamName=streamName, Records=records
+def backoffDelay(attemptsMade):
+    # exponential backoff with full jitter, capped at maxBackoff seconds
+    return random.uniform(0, min(maxBackoff, baseBackoff * 2 ** attemptsMade))
+
+
+def hasTimeToRetry(context, delay):
+    # retries share the invocation's time budget across all batches, stop before Lambda kills the function so the
+    # RuntimeError reaches Firehose
+    return context.get_remaining_time_in_millis() > (delay + retryTimeMargin) * 1000
+
+
+def putRecordsToFirehoseStream(streamName, records, client, context, maxAttempts):
+    for attemptsMade in range(maxAttempts):
+        logger.debug(
+            "putRecordsToFirehoseStream: streamName=%s cntOfRecords=%d attemptsMade=%d maxAttempts=%d",
+            streamName,
+            len(records),
+            attemptsMade,
+            maxAttempts,
         )
-    except Exception as e:
-        failedRecords = records
-        errMsg = str(e)
+        failedRecords = []
+        codes = []
+        errMsg = ""
+        # if put_record_batch throws for whatever reason, response['xx'] will error out, adding a check for a valid
+        # response will prevent this
+        response = None
+        try:
+            response = client.put_record_batch(
+                DeliveryStreamName=streamName, Records=records
+            )
+        except Exception as e:
+            failedRecords = records
+            errMsg = str(e)
+
+        # if there are no failedRecords (put_record_batch succeeded), iterate over the response to gather results
+        if not failedRecords and response and response["FailedPutCount"] > 0:
+            for idx, res in enumerate(response["RequestResponses"]):
+                # (if the result does not have a key 'ErrorCode' OR if it does and is empty) => we do not need to re-ingest
+                if "ErrorCode" not in res or not res["ErrorCode"]:
+                    continue
 
-    # if there are no failedRecords (put_record_batch succeeded), iterate over the response to gather results
-    if not failedRecords and response and response["FailedPutCount"] > 0:
-        for idx, res in enumerate(response["RequestResponses"]):
-            # (if the result does not have a key 'ErrorCode' OR if it does and is empty) => we do not need to re-ingest
-            if "ErrorCode" not in res or not res["ErrorCode"]:
-                continue
+                codes.append(res["ErrorCode"])
+                failedRecords.append(records[idx])
 
-            codes.append(res["ErrorCode"])
-            failedRecords.append(records[idx])
+            errMsg = "Individual error codes: " + ",".join(codes)
 
-        errMsg = "Individual error codes: " + ",".join(codes)
+        if len(failedRecords) == 0:
+            return
 
-    if len(failedRecords) > 0:
-        if attemptsMade + 1 < maxAttempts:
+        if attemptsMade + 1 == maxAttempts:
+            break
+        delay = backoffDelay(attemptsMade)
+        if not hasTimeToRetry(context, delay):
             logger.error(
-                "Some records failed while calling PutRecordBatch to Firehose stream, retrying. %s"
-                % (errMsg)
-            )
-            putRecordsToFirehoseStream(
-                streamName, failedRecords, client, attemptsMade + 1, maxAttempts
-            )
-        else:
-            raise RuntimeError(
-                "Could not put records after %s attempts. %s"
-                % (str(maxAttempts), errMsg)
+                "Some records failed while calling PutRecordBatch to Firehose stream, not enough time left to retry. %s",
+                errMsg,
             )
+            break
+        logger.error(
+            "Some records failed while calling PutRecordBatch to Firehose stream, retrying. %s",
+            errMsg,
+        )
+        records = failedRecords
+        time.sleep(delay)
+
+    raise RuntimeError(
+        "Could not put records after %s attempts. %s" % (str(attemptsMade + 1), errMsg)
+    )
 
 
-def putRecordsToKinesisStream(streamName, records, client, attemptsMade, maxAttempts):
-    logger.debug(
-        "putRecordsToKinesisStream: streamName={} cntOfRecords={} attemptsMade={} maxAttempts={}".format(
-            streamName, len(records), attemptsMade, maxAttempts
+def putRecordsToKinesisStream(streamName, records, client, context, maxAttempts):
+    for attemptsMade in range(maxAttempts):
+        logger.debug(
+            "putRecordsToKinesisStream: streamName=%s cntOfRecords=%d attemptsMade=%d maxAttempts=%d",
+            streamName,
+            len(records),
+            attemptsMade,
+            maxAttempts,
         )
-    )
-    failedRecords = []
-    codes = []
-    errMsg = ""
-    # if put_records throws for whatever reason, response['xx'] will error out, adding a check for a valid
-    # response will prevent this
-    response = None
-    try:
-        response = client.put_records(StreamName=streamName, Records=records)
-    except Exception as e:
-        failedRecords = records
-        errMsg = str(e)
-
-    # if there are no failedRecords (put_record_batch succeeded), iterate over the response to gather results
-    if not failedRecords and response and response["FailedRecordCount"] > 0:
-        for idx, res in enumerate(response["Records"]):
-            # (if the result does not have a key 'ErrorCode' OR if it does and is empty) => we do not need to re-ingest
-            if "ErrorCode" not in res or not res["ErrorCode"]:
-                continue
-
-            codes.append(res["ErrorCode"])
-            failedRecords.append(records[idx])
-
-        errMsg = "Individual error codes: " + ",".join(codes)
-
-    if len(failedRecords) > 0:
-        if attemptsMade + 1 < maxAttempts:
+        failedRecords = []
+        codes = []
+        errMsg = ""
+        # if put_records throws for whatever reason, response['xx'] will error out, adding a check for a valid
+        # response will prevent this
+        response = None
+        try:
+            response = client.put_records(StreamName=streamName, Records=records)
+        except Exception as e:
+            failedRecords = records
+            errMsg = str(e)
+
+        # if there are no failedRecords (put_record_batch succeeded), iterate over the response to gather results
+        if not failedRecords and response and response["FailedRecordCount"] > 0:
+            for idx, res in enumerate(response["Records"]):
+                # (if the result does not have a key 'ErrorCode' OR if it does and is empty) => we do not need to re-ingest
+                if "ErrorCode" not in res or not res["ErrorCode"]:
+                    continue
+
+                codes.append(res["ErrorCode"])
+                failedRecords.append(records[idx])
+
+            errMsg = "Individual error codes: " + ",".join(codes)
+
+        if len(failedRecords) == 0:
+            return
+
+        if attemptsMade + 1 == maxAttempts:
+            break
+        delay = backoffDelay(attemptsMade)
+        if not hasTimeToRetry(context, delay):
             logger.error(
-                "Some records failed while calling PutRecords to Kinesis stream, retrying. %s"
-                % (errMsg)
-            )
-            putRecordsToKinesisStream(
-                streamName, failedRecords, client, attemptsMade + 1, maxAttempts
-            )
-        else:
-            raise RuntimeError(
-                "Could not put records after %s attempts. %s"
-                % (str(maxAttempts), errMsg)
+                "Some records failed while calling PutRecords to Kinesis stream, not enough time left to retry. %s",
+                errMsg,
             )
+            break
+        logger.error(
+            "Some records failed while calling PutRecords to Kinesis stream, retrying. %s",
+            errMsg,
+        )
+        records = failedRecords
+        time.sleep(delay)
 
+    raise RuntimeError(
+        "Could not put records after %s attempts. %s" % (str(attemptsMade + 1), errMsg)
+    )
 
-def createReingestionRecord(isSas, originalRecord):
-    if isSas:
-        return {
-            "data": base64.b64decode(originalRecord["data"]),
-            "partitionKey": originalRecord["kinesisRecordMetadata"]["partitionKey"],
-        }
-    else:
-        return {"data": base64.b64decode(originalRecord["data"])}
 
-
-def getReingestionRecord(isSas, reIngestionRecord):
-    if isSas:
-        return {
-            "Data": reIngestionRecord["data"],
-            "PartitionKey": reIngestionRecord["partitionKey"],
-        }
-    else:
-        return {"Data": reIngestionRecord["data"]}
+def getClient(service, region):
+    # clients are cached at module level so warm invocations do not pay for building them again
+    client = clients.get((service, region))
+    if client is None:
+        client = clients[(service, region)] = boto3.client(service, region_name=region)
+    return client
 
 
 def handler(event, context):
@@ -289,34 +409,41 @@ def handler(event, context):
     streamARN = event["sourceKinesisStreamArn"] if isSas else event["deliveryStreamArn"]
     region = streamARN.split(":")[3]
     streamName = streamARN.split("/")[1]
-    records = list(processRecords(event["records"]))
+    # processRecords yields exactly one result per input record, in order, so the output list can be sized up front
+    records = [None] * len(event["records"])
     projectedSize = 0
-    dataByRecordId = {
-        rec["recordId"]: createReingestionRecord(isSas, rec) for rec in event["records"]
-    }
     putRecordBatches = []
     recordsToReingest = []
     totalRecordsToBeReingested = 0
 
-    for idx, rec in enumerate(records):
-        logger.debug("Record: %s" % (rec))
+    for idx, (rec, rawdata) in enumerate(processRecords(event["records"])):
+        logger.debug("Record: %s", rec)
+        records[idx] = rec
         if rec["result"] != "Ok":
             continue
-        projectedSize += len(rec["data"]) + len(rec["recordId"])
+        # size of the data once base64 encoded
+        projectedSize += (len(rec["data"]) + 2) // 3 * 4 + len(rec["recordId"])
         # Original code set this to 6000000, see note below:
         # 6000000 instead of 6291456 to leave ample headroom for the stuff we didn't account for
         if projectedSize > maxSize:
             logger.debug(
-                "Projected size {} exceeded {}, adding to reingest".format(
-                    projectedSize, maxSize
-                )
+                "Projected size %d exceeded %d, adding to reingest", projectedSize, maxSize
             )
             totalRecordsToBeReingested += 1
-            recordsToReingest.append(
-                getReingestionRecord(isSas, dataByRecordId[rec["recordId"]])
-            )
-            records[idx]["result"] = "Dropped"
-            del records[idx]["data"]
+            if isSas:
+                recordsToReingest.append(
+                    {
+                        "Data": rawdata,
+                        "PartitionKey": event["records"][idx]["kinesisRecordMetadata"]["partitionKey"],
+                    }
+                )
+            else:
+                recordsToReingest.append({"Data": rawdata})
+            rec["result"] = "Dropped"
+            del rec["data"]
+        else:
+            # Firehose expects the data as a base64 string, hand back str so the response serializes as is
+            rec["data"] = base64.b64encode(rec["data"]).decode("ascii")
 
         # split out the record batches into multiple groups, 500 records at max per group
         if len(recordsToReingest) == 500:
@@ -327,40 +454,32 @@ def handler(event, context):
     if len(recordsToReingest) > 0:
         # add the last batch
         logger.debug(
-            "Reingest queue not empty, pushing {} records to stream".format(
-                len(recordsToReingest)
-            )
+            "Reingest queue not empty, pushing %d records to stream", len(recordsToReingest)
         )
         putRecordBatches.append(recordsToReingest)
 
     # iterate and call putRecordBatch for each group
     recordsReingestedSoFar = 0
     if len(putRecordBatches) > 0:
-        client = (
-            boto3.client("kinesis", region_name=region)
-            if isSas
-            else boto3.client("firehose", region_name=region)
-        )
+        client = getClient("kinesis" if isSas else "firehose", region)
         for recordBatch in putRecordBatches:
             if isSas:
                 putRecordsToKinesisStream(
-                    streamName, recordBatch, client, attemptsMade=0, maxAttempts=20
+                    streamName, recordBatch, client, context, maxAttempts=20
                 )
             else:
                 putRecordsToFirehoseStream(
-                    streamName, recordBatch, client, attemptsMade=0, maxAttempts=20
+                    streamName, recordBatch, client, context, maxAttempts=20
                 )
             recordsReingestedSoFar += len(recordBatch)
             logger.info(
-                "Reingested %d/%d records out of %d"
-                % (
-                    recordsReingestedSoFar,
-                    totalRecordsToBeReingested,
-                    len(event["records"]),
-                )
+                "Reingested %d/%d records out of %d",
+                recordsReingestedSoFar,
+                totalRecordsToBeReingested,
+                len(event["records"]),
             )
     else:
         logger.info("No records to be reingested")
 
-    logger.debug("Returning {} records".format(len(records)))
+    logger.debug("Returning %d records", len(records))
     return {"records": records}
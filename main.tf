@@ -207,10 +207,11 @@ resource "aws_lambda_function" "firehose_lambda_transform" {
   filename         = data.archive_file.lambda_function.output_path
   role             = aws_iam_role.kinesis_firehose_lambda.arn
   handler          = "kinesis-firehose-cloudwatch-logs-processor.handler"
-  memory_size      = 160
+  memory_size      = var.lambda_memory_size
   source_code_hash = data.archive_file.lambda_function.output_base64sha256
   runtime          = var.runtime
   timeout          = var.lambda_function_timeout
+  layers           = var.lambda_layers
   environment {
     variables = var.lambda_env_variables
   }
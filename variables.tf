@@ -107,6 +107,11 @@ variable "lambda_function_suffix" {
   default     = "kinesis-firehose-transform"
 }
 
+variable "lambda_memory_size" {
+  description = "Amount of memory in MB the lambda function can use at runtime. Lambda allocates CPU in proportion to memory, a full vCPU at roughly 1769 MB"
+  default     = 160
+}
+
 variable "lambda_function_timeout" {
   description = "The function execution time at which Lambda should terminate the function."
   default     = 180
@@ -115,7 +120,13 @@ variable "lambda_function_timeout" {
 variable "lambda_env_variables" {
   type        = map(string)
   default     = {}
-  description = "Environment variables for lambda function, MAXSIZE, LOG_LEVEL are optional"
+  description = "Environment variables for lambda function, MAXSIZE, LOG_LEVEL, PROCESSING_THREADS are optional. PROCESSING_THREADS only pays off with lambda_memory_size above roughly 1769 MB"
+}
+
+variable "lambda_layers" {
+  type        = list(string)
+  default     = []
+  description = "List of Lambda layer ARNs to attach to the lambda function, e.g. a layer providing orjson and isal"
 }
 
 variable "lambda_iam_policy_name" {